@@ -1,6 +1,7 @@
 from __future__ import annotations
+import time
 import serial  # type: ignore
-import bm1370
+from . import bm1370
 
 RESET_N_HIGH_PACKET: bytes = bytes([0x07, 0x00, 0x00, 0x00, 0x06, 0x01, 0x01])
 
@@ -9,20 +10,52 @@ class SerialInterface:
         self._port = port
         self._baud = baud
         self._ser: serial.Serial | None = None
+        self._cur_timeout: float | None = None
 
     def open(self):
         self._ser = serial.Serial(self._port, self._baud, timeout=0.1)
+        self._cur_timeout = 0.1
 
     def close(self):
         if self._ser:
             self._ser.close()
             self._ser = None
+            self._cur_timeout = None
+
+    def _set_timeout(self, timeout: float):
+        # pySerial reconfigures the port on every timeout assignment
+        if timeout != self._cur_timeout:
+            self._ser.timeout = timeout
+            self._cur_timeout = timeout
 
     def readline(self, timeout: float = 1.0) -> str:
         if not self._ser:
             raise RuntimeError("Serial not open")
-        self._ser.timeout = timeout
+        self._set_timeout(timeout)
         return self._ser.readline().decode(errors="ignore").rstrip()
+
+    def read(self, length: int, timeout_ms: int = 1000) -> bytes:
+        if not self._ser:
+            raise RuntimeError("Serial not open")
+        self._set_timeout(timeout_ms / 1000.0)
+        return self._ser.read(length)
+
+    def read_exact_busy(self, n: int, deadline: float) -> bytes:
+        """
+        Spins on in_waiting until n bytes are read or time.monotonic() passes deadline.
+        Avoids the scheduler latency of a blocking read at the cost of a busy CPU.
+        """
+        if not self._ser:
+            raise RuntimeError("Serial not open")
+        ser = self._ser
+        buf = bytearray()
+        while len(buf) < n:
+            waiting = ser.in_waiting
+            if waiting:
+                buf += ser.read(min(waiting, n - len(buf)))
+            elif time.monotonic() >= deadline:
+                break
+        return bytes(buf)
     
 
 def create_connection_with_ASIC(control_port: str, baud: int = 115200) -> SerialInterface:
@@ -43,7 +76,7 @@ def create_connection_with_ASIC(control_port: str, baud: int = 115200) -> Serial
     return ctrl_serial
 
 
-def send_init_bm1370(ctrl_serial: SerialInterface, asic:bm1370.BM1370, frequency: float = 200.0, expected_chips: int = 1, difficulty: int = 0x1FFFFF):
+def send_init_bm1370(ctrl_serial: SerialInterface, asic:bm1370.BM1370, frequency: float = 200.0, expected_chips: int = 1, difficulty: int = 0x1FFFFF, busy_poll: bool = False):
     """
     Uses bm1370.py to send the init sequence to the chip via the ctrl_serial interface.
 
@@ -53,26 +86,28 @@ def send_init_bm1370(ctrl_serial: SerialInterface, asic:bm1370.BM1370, frequency
         asic: The asic
         expected_chips: Number of expected ASIC chips.
         difficulty: Mining difficulty mask.
+        busy_poll: Busy-poll the serial port for responses instead of blocking reads.
     """
-    # Define TX and RX functions for BM1370
-    def serial_tx_func(data: bytes):
-        if not ctrl_serial._ser:
-            raise RuntimeError("Serial port not open")
-        ctrl_serial._ser.write(data)
-
-    def serial_rx_func(length: int, timeout_ms: int = 1000):
-        if not ctrl_serial._ser:
-            raise RuntimeError("Serial port not open")
-        ctrl_serial._ser.timeout = timeout_ms / 1000.0
-        return ctrl_serial._ser.read(length)
+    if not ctrl_serial._ser:
+        raise RuntimeError("Serial port not open")
+
+    def busy_rx_func(length: int, timeout_ms: int = 1000):
+        return ctrl_serial.read_exact_busy(length, time.monotonic() + timeout_ms / 1000.0)
 
     def reset_func():
         # Optionally implement hardware reset if needed
         pass
 
-    
-    asic.ll_init(serial_tx_func, serial_rx_func, reset_func)
-    asic.send_init(frequency, expected_chips, difficulty)
+    # Hand the bound serial methods straight to the ASIC driver
+    rx_func = busy_rx_func if busy_poll else ctrl_serial.read
+    asic.ll_init(ctrl_serial._ser.write, rx_func, reset_func)
+    try:
+        asic.send_init(frequency, expected_chips, difficulty)
+    finally:
+        if busy_poll:
+            # only spin during init, go back to blocking reads afterwards
+            # even if init failed
+            asic.serial_rx_func = ctrl_serial.read
     return asic
 
 def main():
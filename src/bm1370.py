@@ -1,9 +1,9 @@
 # translated from: bm1370.c
 import struct
-import serial
 import time
 import logging
-import binascii
+import functools
+import contextlib
 
 from .crc_functions import crc5, crc16_false
 
@@ -24,170 +24,286 @@ RESPONSE_JOB = 0x80
 
 MISC_CONTROL = 0x18
 
+# constant register writes sent to all chips during init
+_CMD_REG_A8 = b'\x00\xA8\x00\x07\x00\x00'
+_CMD_MISC_CONTROL = b'\x00\x18\xF0\x00\xC1\x00'
+_CMD_CORE_REG_8B00 = b'\x00\x3C\x80\x00\x8B\x00'
+_CMD_CORE_REG_800C = b'\x00\x3C\x80\x00\x80\x0C'
+_CMD_CORE_REG_8DEE = b'\x00\x3C\x80\x00\x8D\xEE'
+_CMD_IO_DRIVER_STRENGTH = b'\x00\x58\x00\x01\x11\x11'
+_CMD_REG_B9 = b'\x00\xB9\x00\x00\x44\x80'
+_CMD_ANALOG_MUX = b'\x00\x54\x00\x00\x00\x02'
+_CMD_HASH_COUNTING = b'\x00\x10\x00\x00\x1E\xB5'
+_CMD_ADDRESS_0 = b'\x00\x00'
+
+# (refdiv, postdiv1, postdiv2) in the order the C driver searches them
+_PLL_CANDIDATES = [(r, p1, p2) for r in (2, 1) for p1 in range(7, 0, -1) for p2 in range(7, 0, -1) if p1 >= p2]
+
+# _solve_pll results for the usual frequency menu (MHz), so they skip the search
+_PLL_TABLE = {
+    200.0: (0xE0, 2, 7, 2, 200.0),
+    250.0: (0xC8, 2, 5, 2, 250.0),
+    300.0: (0xA8, 2, 7, 1, 300.0),
+    350.0: (0xC4, 2, 7, 1, 350.0),
+    400.0: (0xE0, 2, 7, 1, 400.0),
+    425.0: (0xEE, 2, 7, 1, 425.0),
+    450.0: (0xD8, 2, 6, 1, 450.0),
+    475.0: (0xE4, 2, 6, 1, 475.0),
+    490.0: (0xC4, 2, 5, 1, 490.0),
+    500.0: (0xC8, 2, 5, 1, 500.0),
+    525.0: (0xD2, 2, 5, 1, 525.0),
+    550.0: (0xDC, 2, 5, 1, 550.0),
+    575.0: (0xE6, 2, 5, 1, 575.0),
+    600.0: (0xC0, 2, 4, 1, 600.0),
+    625.0: (0xC8, 2, 4, 1, 625.0),
+    650.0: (0xD0, 2, 4, 1, 650.0),
+    675.0: (0xD8, 2, 4, 1, 675.0),
+    700.0: (0xE0, 2, 4, 1, 700.0),
+}
+
+@functools.lru_cache(maxsize=None)
+def _solve_pll(target_freq, max_diff=1.0):
+    # returns (fb_divider, ref_divider, post_divider1, post_divider2, newf) or None
+    # frequencies are handled in 0.01MHz steps so the search stays in integers
+    tf100 = int(round(target_freq * 100))
+    best = None
+    # best difference so far is best_num / best_den in 0.01MHz units
+    best_num = int(round(max_diff * 100))
+    best_den = 1
+    for refdiv, postdiv1, postdiv2 in _PLL_CANDIDATES:
+        div = refdiv * postdiv1 * postdiv2
+        temp_fb_divider = (div * tf100 + 1250) // 2500
+        if 0xa0 <= temp_fb_divider <= 0xef:
+            diff_num = abs(div * tf100 - 2500 * temp_fb_divider)
+            if diff_num * best_den < best_num * div:
+                best = (temp_fb_divider, refdiv, postdiv1, postdiv2)
+                best_num = diff_num
+                best_den = div
+    if best is None:
+        return None
+    fb_divider, refdiv, postdiv1, postdiv2 = best
+    return best + (25.0 * fb_divider / (refdiv * postdiv2 * postdiv1),)
+
+# bit-reversed value of every byte
+_REV8 = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+# largest packet the chip accepts, header and CRC included
+TX_BUF_SIZE = 272
+
+def _pack_cmd_into(buf, header, data):
+    # frames a command packet at the start of buf (a writable memoryview), returns its length
+    end = 4 + len(data)
+    buf[4:end] = bytes(data)
+    struct.pack_into(">BBBB", buf, 0, 0x55, 0xAA, header, end - 1)
+    struct.pack_into(">B", buf, end, crc5(buf[2:end]))
+    return end + 1
+
+def _pack_job_into(buf, header, data):
+    # same as _pack_cmd_into, but job packets carry a CRC16
+    end = 4 + len(data)
+    buf[4:end] = bytes(data)
+    struct.pack_into(">BBBB", buf, 0, 0x55, 0xAA, header, end)
+    # always bytes, so a numba compiled crc16_false only needs one signature
+    struct.pack_into(">H", buf, end, crc16_false(bytes(buf[2:end])))
+    return end + 2
+
+def build_packet(header, data):
+    pack_into = _pack_job_into if header & TYPE_JOB else _pack_cmd_into
+    buf = memoryview(bytearray(len(data) + 6))
+    return bytes(buf[:pack_into(buf, header, data)])
+
+def _version_mask_cmd(version_mask):
+    versions_to_roll = version_mask >> 13
+    return bytes([0x00, 0xA4, 0x90, 0x00, (versions_to_roll >> 8) & 0xFF, versions_to_roll & 0xFF])
+
+# fully framed packets for the constant part of the init sequence
+_PKT_VERSION_MASK_ALL = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _version_mask_cmd(0xFFFFFFFF))
+_PKT_READ_ADDRESS_0 = build_packet(TYPE_CMD | GROUP_ALL | CMD_READ, _CMD_ADDRESS_0)
+_PKT_CHAIN_INACTIVE = build_packet(TYPE_CMD | GROUP_ALL | CMD_INACTIVE, _CMD_ADDRESS_0)
+_PKT_REG_A8 = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _CMD_REG_A8)
+_PKT_MISC_CONTROL = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _CMD_MISC_CONTROL)
+_PKT_CORE_REG_8B00 = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _CMD_CORE_REG_8B00)
+_PKT_CORE_REG_800C = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _CMD_CORE_REG_800C)
+_PKT_CORE_REG_8DEE = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _CMD_CORE_REG_8DEE)
+_PKT_IO_DRIVER_STRENGTH = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _CMD_IO_DRIVER_STRENGTH)
+_PKT_REG_B9 = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _CMD_REG_B9)
+_PKT_ANALOG_MUX = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _CMD_ANALOG_MUX)
+_PKT_HASH_COUNTING = build_packet(TYPE_CMD | GROUP_ALL | CMD_WRITE, _CMD_HASH_COUNTING)
+
 class BM1370:
     def __init__(self):
         self.chip_id_response = "aa5513700000"
+        self._chip_id_bytes = bytes.fromhex(self.chip_id_response)
+        self._tx_buf = bytearray(TX_BUF_SIZE)
+        self._tx_mv = memoryview(self._tx_buf)
+        self._batch_buf = None
+        self._unbatched_tx_func = None
 
     def ll_init(self, serial_tx_func, serial_rx_func, reset_func):
         self.serial_tx_func = serial_tx_func
         self.serial_rx_func = serial_rx_func
         self.reset_func = reset_func
 
+    def begin_batch(self):
+        # buffer everything sent until flush_batch so it goes out in one write
+        if self._batch_buf is not None:
+            raise RuntimeError("TX batch already open")
+        self._batch_buf = bytearray()
+        self._unbatched_tx_func = self.serial_tx_func
+        self.serial_tx_func = self._batch_buf.extend
+
+    def flush_batch(self):
+        if self._batch_buf is None:
+            raise RuntimeError("No TX batch open")
+        batch = self._batch_buf
+        self.serial_tx_func = self._unbatched_tx_func
+        self._batch_buf = None
+        self._unbatched_tx_func = None
+        if batch:
+            self.serial_tx_func(bytes(batch))
+
+    @contextlib.contextmanager
+    def _tx_batch(self):
+        self.begin_batch()
+        try:
+            yield
+        finally:
+            self.flush_batch()
+
     def send(self, header, data):
-        packet_type = TYPE_JOB if header & TYPE_JOB else TYPE_CMD
-        data_len = len(data)
-        total_length = data_len + 6 if packet_type == TYPE_JOB else data_len + 5
-
-        buf = bytearray(total_length)
-        buf[0] = 0x55
-        buf[1] = 0xAA
-        buf[2] = header
-        buf[3] = data_len + 4 if packet_type == TYPE_JOB else data_len + 3
-        buf[4:4+data_len] = data
-
-        if packet_type == TYPE_JOB:
-            crc16_total = crc16_false(buf[2:4+data_len])
-            buf[4 + data_len] = (crc16_total >> 8) & 0xFF
-            buf[5 + data_len] = crc16_total & 0xFF
+        if header & TYPE_JOB:
+            self._send_job(header, data)
         else:
-            buf[4 + data_len] = crc5(buf[2:4+data_len])
+            self._send_cmd(header, data)
 
-        self.serial_tx_func(buf)
+    def _send_cmd(self, header, data):
+        length = _pack_cmd_into(self._tx_mv, header, data)
+        self.serial_tx_func(bytes(self._tx_mv[:length]))
+
+    def _send_job(self, header, data):
+        length = _pack_job_into(self._tx_mv, header, data)
+        self.serial_tx_func(bytes(self._tx_mv[:length]))
 
     def send_simple(self, data):
         self.serial_tx_func(bytearray(data))
 
     def send_chain_inactive(self):
-        self.send(TYPE_CMD | GROUP_ALL | CMD_INACTIVE, [0x00, 0x00])
+        self.serial_tx_func(_PKT_CHAIN_INACTIVE)
 
     def set_chip_address(self, chipAddr):
-        self.send(TYPE_CMD | GROUP_SINGLE | CMD_SETADDRESS, [chipAddr, 0x00])
+        self._send_cmd(TYPE_CMD | GROUP_SINGLE | CMD_SETADDRESS, [chipAddr, 0x00])
 
     def set_version_mask(self, version_mask):
-        versions_to_roll = version_mask >> 13
-        version_byte0 = (versions_to_roll >> 8) & 0xFF
-        version_byte1 = versions_to_roll & 0xFF
-        version_cmd = [0x00, 0xA4, 0x90, 0x00, version_byte0, version_byte1]
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, version_cmd)
+        self._send_cmd(TYPE_CMD | GROUP_ALL | CMD_WRITE, _version_mask_cmd(version_mask))
 
     def send_hash_frequency(self, target_freq):
         freqbuf = [0x00, 0x08, 0x40, 0xA0, 0x02, 0x41]
-        fb_divider = 0
-        post_divider1 = 0
-        post_divider2 = 0
-        ref_divider = 0
-        min_difference = 10
-        max_diff = 1.0
-        newf = 200.0
-
-        for refdiv in range(2, 0, -1):
-            for postdiv1 in range(7, 0, -1):
-                for postdiv2 in range(7, 0, -1):
-                    if postdiv1 >= postdiv2:
-                        temp_fb_divider = round((postdiv1 * postdiv2 * target_freq * refdiv) / 25.0)
-                        if 0xa0 <= temp_fb_divider <= 0xef:
-                            temp_freq = 25.0 * temp_fb_divider / (refdiv * postdiv2 * postdiv1)
-                            freq_diff = abs(target_freq - temp_freq)
-                            if freq_diff < min_difference and freq_diff < max_diff:
-                                fb_divider = temp_fb_divider
-                                post_divider1 = postdiv1
-                                post_divider2 = postdiv2
-                                ref_divider = refdiv
-                                min_difference = freq_diff
-                                newf = temp_freq
-
-        if fb_divider == 0:
-            logging.error(f"Failed to find PLL settings for target frequency {target_freq:.2f}")
+        pll = _PLL_TABLE.get(target_freq) or _solve_pll(target_freq)
+        if pll is None:
+            logging.error("Failed to find PLL settings for target frequency %.2f", target_freq)
             return
 
+        fb_divider, ref_divider, post_divider1, post_divider2, newf = pll
         freqbuf[3] = fb_divider
         freqbuf[4] = ref_divider
         freqbuf[5] = (((post_divider1 - 1) & 0xf) << 4) + ((post_divider2 - 1) & 0xf)
         if fb_divider * 25 / float(ref_divider) >= 2400:
             freqbuf[2] = 0x50
 
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, freqbuf)
-        logging.info(f"Setting Frequency to {target_freq:.2f}MHz ({newf:.2f})")
+        self._send_cmd(TYPE_CMD | GROUP_ALL | CMD_WRITE, freqbuf)
+        logging.info("Setting Frequency to %.2fMHz (%.2f)", target_freq, newf)
 
     def count_asic_chips(self, expected_count, chip_id_response_length=11):
-        self.send(TYPE_CMD | GROUP_ALL | CMD_READ, [0x00, 0x00])
+        # the chip id read is sent by the caller, as in the reference driver
         chip_counter = 0
-        while True:
-            data = self.serial_rx_func(chip_id_response_length, 5000)
-            if data is None:
+        # read all expected responses at once, then pick up any extra chips
+        # which answer right behind them, one response per read. the chain
+        # has at most 256 chip addresses, which bounds the number of reads
+        length = max(expected_count, 1) * chip_id_response_length
+        timeout_ms = 5000
+        for _ in range(256):
+            data = self.serial_rx_func(length, timeout_ms)
+            if not data:
+                break
+            chip_counter += data.count(self._chip_id_bytes)
+            if len(data) < length:
                 break
-            if self.chip_id_response not in binascii.hexlify(data).decode('utf8'):
-                continue
-            chip_counter += 1
+            length = chip_id_response_length
+            timeout_ms = 200
+        if 0 < expected_count < chip_counter:
+            logging.warning("More ASIC chips than expected (%d) responded, counted %d", expected_count, chip_counter)
         self.send_chain_inactive()
         return chip_counter
 
     def send_init(self, frequency, expected, difficulty, chips_enabled=None):
-        for _ in range(3):
-            self.set_version_mask(0xFFFFFFFF)
+        with self._tx_batch():
+            # the reference driver sends the version mask three times
+            self.serial_tx_func(_PKT_VERSION_MASK_ALL * 3)
 
-        self.send_simple([0x55, 0xAA, 0x52, 0x05, 0x00, 0x00, 0x0A])
-        chip_counter = self.count_asic_chips(expected)
-        if chip_counter == 0:
-            raise Exception("No ASIC chips found")
+            self.serial_tx_func(_PKT_READ_ADDRESS_0)
 
-        self.set_version_mask(0xFFFFFFFF)
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0xA8, 0x00, 0x07, 0x00, 0x00])
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0x18, 0xF0, 0x00, 0xC1, 0x00])
-        self.send_chain_inactive()
+        # RX is unaffected by batching, so the chain inactive sent after
+        # counting goes out together with the rest of the init
+        with self._tx_batch():
+            chip_counter = self.count_asic_chips(expected)
+            if chip_counter == 0:
+                raise Exception("No ASIC chips found")
+
+            self.serial_tx_func(_PKT_VERSION_MASK_ALL)
+            self.serial_tx_func(_PKT_REG_A8)
+            self.serial_tx_func(_PKT_MISC_CONTROL)
+            self.send_chain_inactive()
+
+            address_interval = int(256 / chip_counter)
+            for i in range(chip_counter):
+                self.set_chip_address(i * address_interval)
 
-        address_interval = int(256 / chip_counter)
-        for i in range(chip_counter):
-            self.set_chip_address(i * address_interval)
+            self.serial_tx_func(_PKT_CORE_REG_8B00)
+            self.serial_tx_func(_PKT_CORE_REG_800C)
 
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0x3C, 0x80, 0x00, 0x8B, 0x00])
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0x3C, 0x80, 0x00, 0x80, 0x0C])
+            # Set difficulty mask
+            difficulty_mask = self.get_difficulty_mask(difficulty)
+            self._send_cmd(TYPE_CMD | GROUP_ALL | CMD_WRITE, difficulty_mask)
 
-        # Set difficulty mask
-        difficulty_mask = self.get_difficulty_mask(difficulty)
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, difficulty_mask)
+            self.serial_tx_func(_PKT_IO_DRIVER_STRENGTH)
 
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0x58, 0x00, 0x01, 0x11, 0x11])
+            for i in range(chip_counter):
+                addr = i * address_interval
+                self._send_cmd(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0xA8, 0x00, 0x07, 0x01, 0xF0])
+                self._send_cmd(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0x18, 0xF0, 0x00, 0xC1, 0x00])
+                self._send_cmd(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0x3C, 0x80, 0x00, 0x8B, 0x00])
+                self._send_cmd(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0x3C, 0x80, 0x00, 0x80, 0x0C])
+                self._send_cmd(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0x3C, 0x80, 0x00, 0x82, 0xAA])
 
-        for i in range(chip_counter):
-            addr = i * address_interval
-            self.send(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0xA8, 0x00, 0x07, 0x01, 0xF0])
-            self.send(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0x18, 0xF0, 0x00, 0xC1, 0x00])
-            self.send(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0x3C, 0x80, 0x00, 0x8B, 0x00])
-            self.send(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0x3C, 0x80, 0x00, 0x80, 0x0C])
-            self.send(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [addr, 0x3C, 0x80, 0x00, 0x82, 0xAA])
+            self.serial_tx_func(_PKT_REG_B9)
+            self.serial_tx_func(_PKT_ANALOG_MUX)
+            self.serial_tx_func(_PKT_REG_B9)
+            self.serial_tx_func(_PKT_CORE_REG_8DEE)
 
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0xB9, 0x00, 0x00, 0x44, 0x80])
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0x54, 0x00, 0x00, 0x00, 0x02])
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0xB9, 0x00, 0x00, 0x44, 0x80])
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0x3C, 0x80, 0x00, 0x8D, 0xEE])
+            self.send_hash_frequency(frequency)
 
-        self.send_hash_frequency(frequency)
+            self.serial_tx_func(_PKT_HASH_COUNTING)
 
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, [0x00, 0x10, 0x00, 0x00, 0x1E, 0xB5])
         return chip_counter
 
     def get_difficulty_mask(self, difficulty):
         # This should match the C function get_difficulty_mask
-        mask = [0x00, 0x14, 0x00, 0x00, 0x00, 0xFF]
-        difficulty = self._largest_power_of_two(difficulty) - 1
-        for i in range(4):
-            value = (difficulty >> (8 * i)) & 0xFF
-            mask[5 - i] = self._reverse_bits(value)
-        return mask
+        diff = (self._largest_power_of_two(difficulty) - 1) & 0xFFFFFFFF
+        return bytes([0x00, 0x14,
+                      _REV8[(diff >> 24) & 0xFF], _REV8[(diff >> 16) & 0xFF],
+                      _REV8[(diff >> 8) & 0xFF], _REV8[diff & 0xFF]])
 
     def _largest_power_of_two(self, n):
-        p = 1
-        while p * 2 <= n:
-            p *= 2
-        return p
+        if n < 2:
+            return 1
+        return 1 << (n.bit_length() - 1)
 
     def _reverse_bits(self, byte):
-        return int('{:08b}'.format(byte)[::-1], 2)
+        return _REV8[byte]
 
     def set_default_baud(self):
         baudrate = [0x00, MISC_CONTROL, 0x00, 0x00, 0b01111010, 0b00110001]
-        self.send(TYPE_CMD | GROUP_ALL | CMD_WRITE, baudrate)
+        self._send_cmd(TYPE_CMD | GROUP_ALL | CMD_WRITE, baudrate)
         return 115749
 
     def set_max_baud(self):
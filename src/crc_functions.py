@@ -1,40 +1,41 @@
 # translated from: https://github.com/skot/ESP-Miner
 
-CRC5_MASK = 0x1F
-
-def crc5(data):
-    length = len(data)
+# compile the job packet CRC16 with numba when it is installed. crc5 stays plain
+# python: command packets are too short to beat numba's call overhead
+# with numba, crc16_false only accepts bytes-like input (not lists), and is
+# compiled once per input type, so callers should stick to bytes
+try:
+    from numba import njit
+    _jit = njit(cache=True)
+except ImportError:
+    def _jit(func):
+        return func
 
-    crc = CRC5_MASK
-    crcin = [1, 1, 1, 1, 1]
-    crcout = [1, 1, 1, 1, 1]
+CRC5_MASK = 0x1F
 
-    length *= 8  # Convert length from bytes to bits
-    bit_pos = 7
-    byte_index = 0
+CRC5_POLY = 0x05
 
-    for i in range(length):
-        din = (data[byte_index] & (1 << bit_pos)) != 0
-        crcout[0] = crcin[4] ^ din
-        crcout[1] = crcin[0]
-        crcout[2] = crcin[1] ^ crcin[4] ^ din
-        crcout[3] = crcin[2]
-        crcout[4] = crcin[3]
-        if bit_pos == 0:
-            bit_pos = 7
-            byte_index += 1
+def _crc5_table_entry(byte):
+    # the 5 bit register is kept in the top bits of a byte so a whole input
+    # byte can be folded in per lookup
+    crc = byte
+    for _ in range(8):
+        if crc & 0x80:
+            crc = ((crc << 1) ^ (CRC5_POLY << 3)) & 0xFF
         else:
-            bit_pos -= 1
-        crcin[:] = crcout[:]
+            crc = (crc << 1) & 0xFF
+    return crc
 
-    crc = 0
-    for bit in range(5):
-        crc |= crcin[bit] << bit
+crc5_table = tuple(_crc5_table_entry(i) for i in range(256))
 
-    return crc
+def crc5(data):
+    crc = CRC5_MASK << 3
+    for byte in data:
+        crc = crc5_table[crc ^ byte]
+    return crc >> 3
 
-# CRC-16/CCITT Lookup Table
-crc16_table = [
+# CRC-16/CCITT Lookup Table (a tuple so numba can treat it as a constant)
+crc16_table = (
     0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50A5, 0x60C6, 0x70E7,
 	0x8108, 0x9129, 0xA14A, 0xB16B, 0xC18C, 0xD1AD, 0xE1CE, 0xF1EF,
 	0x1231, 0x0210, 0x3273, 0x2252, 0x52B5, 0x4294, 0x72F7, 0x62D6,
@@ -67,16 +68,17 @@ crc16_table = [
 	0x7C26, 0x6C07, 0x5C64, 0x4C45, 0x3CA2, 0x2C83, 0x1CE0, 0x0CC1,
     0xEF1F, 0xFF3E, 0xCF5D, 0xDF7C, 0xAF9B, 0xBFBA, 0x8FD9, 0x9FF8,
     0x6E17, 0x7E36, 0x4E55, 0x5E74, 0x2E93, 0x3EB2, 0x0ED1, 0x1EF0
-]
+)
 
 def crc16(buffer):
     crc = 0
     for byte in buffer:
-        crc = (crc << 8) ^ crc16_table[((crc >> 8) ^ byte) & 0xFF]
-    return crc & 0xFFFF  # Ensure CRC is within 16-bit range
+        crc = ((crc << 8) ^ crc16_table[((crc >> 8) ^ byte) & 0xFF]) & 0xFFFF
+    return crc
 
+@_jit
 def crc16_false(buffer):
     crc = 0xffff
     for byte in buffer:
-        crc = (crc << 8) ^ crc16_table[((crc >> 8) ^ byte) & 0xFF]
-    return crc & 0xFFFF  # Ensure CRC is within 16-bit range
\ No newline at end of file
+        crc = ((crc << 8) ^ crc16_table[((crc >> 8) ^ byte) & 0xFF]) & 0xFFFF
+    return crc
\ No newline at end of file
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+pytest.importorskip("serial")
+
+from src.bitaxerawpy import SerialInterface, send_init_bm1370
+from src.bm1370 import BM1370
+
+
+class FakeSerial:
+    # stands in for serial.Serial: each queued chunk becomes readable in turn
+    def __init__(self, chunks=()):
+        self.chunks = [bytes(c) for c in chunks]
+        self.timeout_sets = 0
+        self._timeout = 0.1
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.timeout_sets += 1
+        self._timeout = value
+
+    @property
+    def in_waiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, size=1):
+        if not self.chunks:
+            return b""
+        data, rest = self.chunks[0][:size], self.chunks[0][size:]
+        if rest:
+            self.chunks[0] = rest
+        else:
+            self.chunks.pop(0)
+        return data
+
+    def readline(self):
+        return self.read(self.in_waiting)
+
+    def write(self, data):
+        return len(data)
+
+
+def open_fake(ser):
+    # what SerialInterface.open leaves behind, minus the real port
+    ctrl_serial = SerialInterface("fake")
+    ctrl_serial._ser = ser
+    ctrl_serial._cur_timeout = ser.timeout
+    return ctrl_serial
+
+
+def test_read_exact_busy_collects_chunks():
+    ctrl_serial = open_fake(FakeSerial([b"ab", b"cde", b"fg"]))
+    assert ctrl_serial.read_exact_busy(5, time.monotonic() + 1.0) == b"abcde"
+
+
+def test_read_exact_busy_short_read_at_deadline():
+    ctrl_serial = open_fake(FakeSerial([b"ab"]))
+    start = time.monotonic()
+    assert ctrl_serial.read_exact_busy(5, start + 0.05) == b"ab"
+    assert time.monotonic() - start >= 0.05
+
+
+def test_busy_poll_restored_after_failed_init():
+    # one response that isn't a chip id, so init finds no chips
+    ctrl_serial = open_fake(FakeSerial([bytes(11)]))
+    asic = BM1370()
+    with pytest.raises(Exception, match="No ASIC chips found"):
+        send_init_bm1370(ctrl_serial, asic, busy_poll=True)
+    assert asic.serial_rx_func == ctrl_serial.read
+
+
+def test_timeout_only_set_when_changed():
+    ser = FakeSerial([b"x"] * 5 + [b"line\n"] * 2)
+    ctrl_serial = open_fake(ser)
+    for _ in range(3):
+        ctrl_serial.read(1, 1000)
+    assert ser.timeout_sets == 1
+    ctrl_serial.readline(1.0)
+    assert ser.timeout_sets == 1
+    ctrl_serial.read(1, 100)
+    ctrl_serial.read(1, 100)
+    assert ser.timeout_sets == 2
+    ctrl_serial.readline(1.0)
+    assert ser.timeout_sets == 3
+    assert ser.timeout == 1.0
@@ -0,0 +1,158 @@
+import pytest
+
+from src.crc_functions import crc5, crc16_false
+from src.bm1370 import BM1370, build_packet, _solve_pll, _PLL_TABLE, TYPE_CMD, TYPE_JOB, GROUP_ALL, GROUP_SINGLE, CMD_READ, CMD_WRITE, CMD_INACTIVE, CMD_SETADDRESS
+
+
+# frames as listed in the reference C driver (docs/bm1370.c)
+def test_crc5_known_frames():
+    assert crc5(bytes.fromhex("52050000")) == 0x0A
+    assert crc5(bytes.fromhex("53050000")) == 0x03
+    assert crc5(bytes.fromhex("510900a800070000")) == 0x03
+    assert crc5(bytes.fromhex("51090018f000c100")) == 0x04
+    assert crc5(bytes.fromhex("5109003c80008b00")) == 0x12
+    assert crc5(bytes.fromhex("410900a8000701f0")) == 0x15
+
+
+def test_crc16_false_check_values():
+    assert crc16_false(b"") == 0xFFFF
+    assert crc16_false(b"123456789") == 0x29B1
+
+
+def test_build_cmd_packet():
+    # the frame send_init used to send by hand to read the chip ids
+    assert build_packet(TYPE_CMD | GROUP_ALL | CMD_READ, b"\x00\x00") == bytes.fromhex("55aa520500000a")
+    assert build_packet(TYPE_CMD | GROUP_ALL | CMD_INACTIVE, [0x00, 0x00]) == bytes.fromhex("55aa5305000003")
+    assert build_packet(TYPE_CMD | GROUP_SINGLE | CMD_WRITE, [0x00, 0xA8, 0x00, 0x07, 0x01, 0xF0]) == \
+        bytes.fromhex("55aa410900a8000701f015")
+
+
+def test_build_job_packet():
+    assert build_packet(TYPE_JOB | GROUP_SINGLE | CMD_WRITE, bytes(range(8))) == \
+        bytes.fromhex("55aa210c000102030405060724d2")
+
+
+def test_solve_pll():
+    assert _solve_pll(200.0) == (0xE0, 2, 7, 2, 200.0)
+    # 212.5 * divider / 25 lands on .5 for the odd refdiv=1 dividers
+    assert _solve_pll(212.5) == (0xEE, 2, 7, 2, 212.5)
+    assert _solve_pll(412.5) == (0xE7, 2, 7, 1, 412.5)
+    assert _solve_pll(433.3) == (0xD0, 2, 6, 1, 433.3333333333333)
+    assert _solve_pll(625.3) == (0xC8, 2, 4, 1, 625.0)
+    assert _solve_pll(1300.0) == (0xD0, 2, 2, 1, 1300.0)
+    # no divider combination gets within 1MHz
+    assert _solve_pll(1199.0) is None
+
+
+def test_pll_table_matches_solver():
+    for freq, pll in _PLL_TABLE.items():
+        assert pll == _solve_pll.__wrapped__(freq), freq
+
+
+CHIP_ID_RESPONSE = bytes.fromhex("aa5513700000") + bytes(5)
+READ_CHIP_ID = build_packet(TYPE_CMD | GROUP_ALL | CMD_READ, b"\x00\x00")
+
+
+class FakeASICPort:
+    # a chain of chips behind a serial port: every chip id read written to it
+    # queues one response per chip, reads time out once the input is exhausted
+    def __init__(self, chips):
+        self.chips = chips
+        self.rx = b""
+        self.tx = []
+
+    def write(self, data):
+        self.tx.append(bytes(data))
+        self.rx += CHIP_ID_RESPONSE * self.chips * bytes(data).count(READ_CHIP_ID)
+
+    def read(self, length, timeout_ms=1000):
+        data, self.rx = self.rx[:length], self.rx[length:]
+        return data
+
+
+def make_asic(chips):
+    port = FakeASICPort(chips)
+    asic = BM1370()
+    asic.ll_init(port.write, port.read, lambda: None)
+    return asic, port
+
+
+def count_chips(chips, expected):
+    asic, port = make_asic(chips)
+    port.write(READ_CHIP_ID)
+    count = asic.count_asic_chips(expected)
+    assert port.rx == b""
+    return count
+
+
+def test_count_asic_chips_exact():
+    assert count_chips(1, 1) == 1
+    assert count_chips(4, 4) == 4
+
+
+def test_count_asic_chips_fewer_than_expected():
+    assert count_chips(2, 4) == 2
+
+
+def test_count_asic_chips_more_than_expected():
+    assert count_chips(4, 1) == 4
+    assert count_chips(6, 4) == 6
+
+
+def test_send_init_counts_chips():
+    for chips in (1, 3):
+        asic, port = make_asic(chips)
+        assert asic.send_init(400.0, chips, 256) == chips
+        assert port.rx == b""
+
+
+def test_send_init_tx_sequence():
+    asic, port = make_asic(1)
+    asic.send_init(400.0, 1, 256)
+
+    def cmd(header, *data):
+        return build_packet(header, bytes(data))
+
+    all_write = TYPE_CMD | GROUP_ALL | CMD_WRITE
+    one_write = TYPE_CMD | GROUP_SINGLE | CMD_WRITE
+    version_mask = cmd(all_write, 0x00, 0xA4, 0x90, 0x00, 0xFF, 0xFF)
+    chain_inactive = cmd(TYPE_CMD | GROUP_ALL | CMD_INACTIVE, 0x00, 0x00)
+    before_rx = version_mask * 3 + READ_CHIP_ID
+    after_rx = b"".join([
+        chain_inactive,
+        version_mask,
+        cmd(all_write, 0x00, 0xA8, 0x00, 0x07, 0x00, 0x00),
+        cmd(all_write, 0x00, 0x18, 0xF0, 0x00, 0xC1, 0x00),
+        chain_inactive,
+        cmd(TYPE_CMD | GROUP_SINGLE | CMD_SETADDRESS, 0x00, 0x00),
+        cmd(all_write, 0x00, 0x3C, 0x80, 0x00, 0x8B, 0x00),
+        cmd(all_write, 0x00, 0x3C, 0x80, 0x00, 0x80, 0x0C),
+        cmd(all_write, 0x00, 0x14, 0x00, 0x00, 0x00, 0xFF),
+        cmd(all_write, 0x00, 0x58, 0x00, 0x01, 0x11, 0x11),
+        cmd(one_write, 0x00, 0xA8, 0x00, 0x07, 0x01, 0xF0),
+        cmd(one_write, 0x00, 0x18, 0xF0, 0x00, 0xC1, 0x00),
+        cmd(one_write, 0x00, 0x3C, 0x80, 0x00, 0x8B, 0x00),
+        cmd(one_write, 0x00, 0x3C, 0x80, 0x00, 0x80, 0x0C),
+        cmd(one_write, 0x00, 0x3C, 0x80, 0x00, 0x82, 0xAA),
+        cmd(all_write, 0x00, 0xB9, 0x00, 0x00, 0x44, 0x80),
+        cmd(all_write, 0x00, 0x54, 0x00, 0x00, 0x00, 0x02),
+        cmd(all_write, 0x00, 0xB9, 0x00, 0x00, 0x44, 0x80),
+        cmd(all_write, 0x00, 0x3C, 0x80, 0x00, 0x8D, 0xEE),
+        cmd(all_write, 0x00, 0x08, 0x50, 0xE0, 0x02, 0x60),
+        cmd(all_write, 0x00, 0x10, 0x00, 0x00, 0x1E, 0xB5),
+    ])
+    # one batched write each side of the chip id responses
+    assert port.tx == [before_rx, after_rx]
+
+
+def test_tx_batch_rejects_nesting():
+    asic, port = make_asic(1)
+    with pytest.raises(RuntimeError):
+        asic.flush_batch()
+    with pytest.raises(RuntimeError):
+        with asic._tx_batch():
+            asic.send_chain_inactive()
+            asic.begin_batch()
+    # the outer batch was still flushed and the real TX function restored
+    asic.send_chain_inactive()
+    assert port.tx == [build_packet(TYPE_CMD | GROUP_ALL | CMD_INACTIVE, b"\x00\x00")] * 2